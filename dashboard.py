@@ -1,10 +1,20 @@
 
+import mmap
+
 import streamlit as st
 import pandas as pd
-import json
-import time
+import orjson
 from pathlib import Path
 
+from watchfiles import watch
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_dataset
+    import pyarrow.parquet as pa_parquet
+except ImportError:
+    pa_dataset = None
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="Aegis Security Dashboard",
@@ -18,100 +28,246 @@ st.caption("Real-time monitoring of the Aegis Generic Security Middleware.")
 
 # --- Helper Functions ---
 LOG_FILE = Path("security_events.json")
+CONFIG_FILE = Path("config.json")
+GENERATED_REGEX_FILE = Path("generated_regex.json")
+PARQUET_LOG_DIR = Path("logs")
 
-def load_data():
-    """Loads and processes security events from the JSON log file."""
-    if not LOG_FILE.exists() or LOG_FILE.stat().st_size < 5:  # Check for empty or near-empty file
+def load_parquet_history(partitions) -> pd.DataFrame:
+    """Loads rotated event history from the server's Parquet partitions.
+
+    The partitions already carry flattened 'details.*' columns, so this skips
+    JSON parsing entirely and goes straight from columnar storage to pandas.
+    """
+    if not partitions:
         return pd.DataFrame()
+    # Partitions are time slices, so their 'details.*' column sets differ;
+    # unify the schemas explicitly or the dataset silently drops any column
+    # missing from the first partition.
+    paths = [str(p) for p in partitions]
+    schema = pa.unify_schemas([pa_parquet.read_schema(p) for p in paths])
+    df = pa_dataset.dataset(paths, format="parquet", schema=schema).to_table().to_pandas()
+    if "timestamp" in df.columns:
+        df["timestamp"] = pd.to_datetime(df["timestamp"]).dt.strftime('%Y-%m-%d %H:%M:%S')
+    return df
+
+def load_data():
+    """Loads security events incrementally, parsing only bytes appended since the last refresh."""
+    cache = st.session_state.setdefault(
+        "log_tail", {"offset": 0, "df": pd.DataFrame(), "initialized": False}
+    )
+
+    jsonl_size = LOG_FILE.stat().st_size if LOG_FILE.exists() else 0
+
+    # Rebuild from the Parquet history on first load or when the JSONL file
+    # shrank (rotation or truncation); otherwise keep tailing. The server only
+    # truncates the spill file after a partition is fully written, so keying
+    # the rebuild on the shrink sees the new partition and the emptied spill
+    # together - reacting to the partition's appearance alone would re-read
+    # the still-full spill and double-count every rotated event.
+    if not cache["initialized"] or jsonl_size < cache["offset"]:
+        partitions = ()
+        if pa_dataset is not None and PARQUET_LOG_DIR.is_dir():
+            partitions = tuple(sorted(PARQUET_LOG_DIR.glob("*.parquet")))
+        cache["offset"] = 0
+        cache["df"] = load_parquet_history(partitions)
+        cache["initialized"] = True
+
+    if jsonl_size < 5:  # Empty or near-empty spill file
+        return cache["df"]
 
     try:
-        # Load the entire list of JSON objects from the file
-        with open(LOG_FILE, "r") as f:
-            data = json.load(f)
-        
+        # Memory-map the log so records are parsed straight out of the page
+        # cache, line by line, without copying the whole file into a buffer.
+        with open(LOG_FILE, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Only consume up to the last complete line; a line the server
+                # is still writing will be picked up on the next refresh.
+                end = mm.rfind(b"\n") + 1
+                if end <= cache["offset"]:
+                    return cache["df"]
+
+                data = []
+                pos = cache["offset"]
+                while pos < end:
+                    newline = mm.find(b"\n", pos, end)
+                    line = mm[pos:newline]
+                    if line.strip():
+                        data.append(orjson.loads(line))
+                    pos = newline + 1
+                cache["offset"] = end
+
         if not data:
-            return pd.DataFrame()
+            return cache["df"]
 
-        df = pd.DataFrame(data)
+        # Flatten the nested 'details' object into 'details.*' columns directly
+        # on the dicts; much faster than pd.json_normalize for one-level nesting
+        for rec in data:
+            details = rec.pop("details", None)
+            if isinstance(details, dict):
+                for key, value in details.items():
+                    rec[f"details.{key}"] = value
+            else:
+                rec["details"] = details
 
-        # Normalize the 'details' column which contains nested JSON objects
-        # This will create new columns like 'details.reason', 'details.original_content', etc.
-        details_normalized = pd.json_normalize(df['details'], max_level=1).add_prefix('details.')
-        
-        # Drop the original 'details' column and join the new flattened columns
-        df = df.drop('details', axis=1).join(details_normalized)
+        new_df = pd.DataFrame(data)
 
         # Convert timestamp to datetime and format it
-        if "timestamp" in df.columns:
-            df["timestamp"] = pd.to_datetime(df["timestamp"]).dt.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return df
-    
-    except (json.JSONDecodeError, ValueError, FileNotFoundError) as e:
+        if "timestamp" in new_df.columns:
+            new_df["timestamp"] = pd.to_datetime(new_df["timestamp"]).dt.strftime('%Y-%m-%d %H:%M:%S')
+
+        if cache["df"].empty:
+            cache["df"] = new_df
+        else:
+            cache["df"] = pd.concat([cache["df"], new_df], ignore_index=True, copy=False)
+        return cache["df"]
+
+    except (ValueError, FileNotFoundError) as e:
         # Display an error in the dashboard if the log file is corrupt
         st.error(f"Error loading or parsing log file: {e}")
-        return pd.DataFrame()
+        return cache["df"]
 
-def style_rows(row):
-    """Applies color coding to rows based on the action taken."""
-    if "action" not in row:
-        return [""] * len(row)
-    action = row["action"]
-    if "BLOCKED" in action or "DENIED" in action:
-        color = "background-color: #ff4d4d; color: white;"  # Red
-    elif "REDACTED" in action:
-        color = "background-color: #ffcc00;"  # Yellow
-    elif "RESET" in action:
-        color = "background-color: #00bfff; color: white;" # Blue
-    elif "ALLOWED" in action:
-        color = "background-color: #4CAF50; color: white;"  # Green
-    else:
-        color = ""
-    return [color] * len(row)
+# Per-action row colors: red for blocks/denials, yellow for redactions,
+# blue for resets, green for allowed traffic.
+STYLE_MAP = {
+    "BLOCKED_INPUT": "background-color: #ff4d4d; color: white;",
+    "DENIED_ACCESS": "background-color: #ff4d4d; color: white;",
+    "REDACTED_OUTPUT": "background-color: #ffcc00;",
+    "SESSION_RESET": "background-color: #00bfff; color: white;",
+    "ALLOWED_INPUT": "background-color: #4CAF50; color: white;",
+    "ALLOWED_OUTPUT": "background-color: #4CAF50; color: white;",
+}
 
-# --- Main Dashboard Area ---
-placeholder = st.empty()
+def style_rows(df_display):
+    """Returns a same-shaped frame of CSS styles, coloring each row by its action.
+
+    One vectorized map over the action column replaces a Python callback per
+    row, so styling cost no longer scales with Python call overhead.
+    """
+    if "action" not in df_display.columns:
+        return pd.DataFrame("", index=df_display.index, columns=df_display.columns)
+    colors = df_display["action"].map(STYLE_MAP).fillna("")
+    return pd.DataFrame({col: colors for col in df_display.columns})
+
+@st.cache_data(show_spinner=False)
+def compute_kpis(log_mtime_ns: int, log_size: int) -> dict:
+    """Aggregates the KPI counts, cached on the log file's (mtime, size) key.
 
-# --- Auto-Refresh Loop ---
-while True:
+    As long as the log file is unchanged the cached result is served without
+    touching the DataFrame at all.
+    """
     df = load_data()
+    if df.empty or "action" not in df.columns:
+        return {"total": 0, "blocked": 0, "redacted": 0, "denied": 0}
+    # One pass over the action column instead of a boolean-mask scan per KPI
+    counts = df["action"].value_counts()
+    return {
+        "total": len(df),
+        "blocked": int(counts.get("BLOCKED_INPUT", 0)),
+        "redacted": int(counts.get("REDACTED_OUTPUT", 0)),
+        "denied": int(counts.get("DENIED_ACCESS", 0)),
+    }
+
+# Define which columns to display for a cleaner look
+# The full, detailed log is still available if needed
+DISPLAY_COLUMNS = [
+    "timestamp", "event_type", "action", "risk_score",
+    "details.reason", "details.original_content", "details.redacted_data"
+]
+
+# The audit-log viewport is 500px tall, so styling and shipping more than the
+# last 500 rows to the browser is wasted work however large the log grows.
+DISPLAY_ROWS = 500
+
+@st.cache_data(show_spinner=False)
+def compute_display_tail(log_mtime_ns: int, log_size: int) -> pd.DataFrame:
+    """Returns the last DISPLAY_ROWS events, cached on the log file's (mtime, size) key."""
+    df = load_data()
+    if df.empty:
+        return df
+    # Filter down to only the columns that actually exist in the dataframe
+    existing_display_columns = [col for col in DISPLAY_COLUMNS if col in df.columns]
+    return df[existing_display_columns].tail(DISPLAY_ROWS)
+
+# --- Scanner Sandbox ---
+# The scanners hold transformer models of ~hundred-MB size, so they live in
+# st.cache_resource singletons: created once per process and never hashed or
+# copied between reruns (st.cache_data would attempt both). The llm_guard
+# imports stay inside the factories so the dashboard starts without loading
+# the models until the sandbox is actually used.
+@st.cache_resource
+def get_prompt_scanner():
+    """Singleton PromptInjection scanner configured like the middleware's."""
+    from llm_guard.input_scanners import PromptInjection
+    config = orjson.loads(CONFIG_FILE.read_bytes())
+    return PromptInjection(threshold=config.get("prompt_injection_threshold", 0.99))
 
-    with placeholder.container():
-        # --- KPI Metrics ---
-        if not df.empty and "action" in df.columns:
-            total_events = len(df)
-            injections_blocked = df[df["action"] == "BLOCKED_INPUT"].shape[0]
-            pii_leaks_prevented = df[df["action"] == "REDACTED_OUTPUT"].shape[0]
-            access_denials = df[df["action"] == "DENIED_ACCESS"].shape[0]
+@st.cache_resource
+def get_pii_scanner():
+    """Singleton Sensitive scanner configured like the middleware's."""
+    from llm_guard.output_scanners.sensitive import Sensitive
+    config = orjson.loads(CONFIG_FILE.read_bytes())
+    return Sensitive(
+        entity_types=config.get("pii_entities_to_scan", []),
+        redact=config.get("pii_scan_redact", True),
+        threshold=config.get("pii_scan_threshold", 0.1),
+        regex_pattern_groups_path=str(GENERATED_REGEX_FILE)
+    )
+
+with st.sidebar:
+    st.subheader("🔬 Scanner Sandbox")
+    st.caption("Run ad-hoc text through the same scanners the middleware uses.")
+    sandbox_text = st.text_area("Text to scan", key="sandbox_text")
+    if st.button("Scan") and sandbox_text:
+        _, prompt_ok, prompt_risk = get_prompt_scanner().scan(sandbox_text)
+        if prompt_ok:
+            st.success(f"No prompt injection detected (risk score: {prompt_risk})")
         else:
-            total_events, injections_blocked, pii_leaks_prevented, access_denials = 0, 0, 0, 0
-
-        kpi1, kpi2, kpi3, kpi4 = st.columns(4)
-        kpi1.metric(label="🛡️ Total Events", value=total_events)
-        kpi2.metric(label="🚨 Injections Blocked", value=injections_blocked)
-        kpi3.metric(label="🔒 PII Leaks Prevented", value=pii_leaks_prevented)
-        kpi4.metric(label="❌ Access Denied", value=access_denials)
-
-        st.markdown("---")
-
-        # --- Live Audit Log ---
-        st.subheader("Live Audit Log")
-        if not df.empty:
-            # Define which columns to display for a cleaner look
-            # The full, detailed log is still available if needed
-            display_columns = [
-                "timestamp", "event_type", "action", "risk_score", 
-                "details.reason", "details.original_content", "details.redacted_data"
-            ]
-            # Filter down to only the columns that actually exist in the dataframe
-            existing_display_columns = [col for col in display_columns if col in df.columns]
-
-            st.dataframe(
-                df[existing_display_columns].style.apply(style_rows, axis=1),
-                use_container_width=True,
-                height=500
-            )
+            st.error(f"Prompt injection detected (risk score: {prompt_risk})")
+        redacted, pii_ok, pii_risk = get_pii_scanner().scan(prompt="scan", output=sandbox_text)
+        if pii_ok:
+            st.success(f"No sensitive PII detected (risk score: {pii_risk})")
         else:
-            st.info("No security events logged yet. Start the MCP server and interact with the agent.")
+            st.warning(f"Sensitive PII detected (risk score: {pii_risk})")
+            st.code(redacted)
+
+# --- Main Dashboard Area ---
+# The static layout (columns, divider, subheader) is built exactly once; a
+# refresh only rewrites the metric and table slots, so Streamlit diffs four
+# metrics and one table instead of reconstructing the whole container.
+kpi1, kpi2, kpi3, kpi4 = st.columns(4)
+kpi_slots = (kpi1.empty(), kpi2.empty(), kpi3.empty(), kpi4.empty())
+st.markdown("---")
+st.subheader("Live Audit Log")
+table_slot = st.empty()
+
+def render_dashboard():
+    """Refreshes the KPI metric and audit-log slots from the current log state."""
+    if LOG_FILE.exists():
+        log_stat = LOG_FILE.stat()
+        kpis = compute_kpis(log_stat.st_mtime_ns, log_stat.st_size)
+        tail = compute_display_tail(log_stat.st_mtime_ns, log_stat.st_size)
+    else:
+        kpis = {"total": 0, "blocked": 0, "redacted": 0, "denied": 0}
+        tail = pd.DataFrame()
+
+    kpi_slots[0].metric(label="🛡️ Total Events", value=kpis["total"])
+    kpi_slots[1].metric(label="🚨 Injections Blocked", value=kpis["blocked"])
+    kpi_slots[2].metric(label="🔒 PII Leaks Prevented", value=kpis["redacted"])
+    kpi_slots[3].metric(label="❌ Access Denied", value=kpis["denied"])
+
+    if not tail.empty:
+        table_slot.dataframe(
+            tail.style.apply(style_rows, axis=None),
+            use_container_width=True,
+            height=500
+        )
+    else:
+        table_slot.info("No security events logged yet. Start the MCP server and interact with the agent.")
 
-    time.sleep(2)
+# --- File-Watch Refresh Loop ---
+# Instead of polling every 2 seconds, re-render only when the log file actually
+# changes. The watcher monitors the log's directory so it also catches the file
+# being created after the dashboard starts.
+render_dashboard()
+for _changes in watch(LOG_FILE.parent.resolve(), watch_filter=lambda _change, path: Path(path).name == LOG_FILE.name):
+    render_dashboard()
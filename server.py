@@ -1,33 +1,74 @@
+import asyncio
+import collections
+import functools
 import logging
+import re
 import sys
-import json
 import datetime
 import os
+import queue
+import threading
 from typing import Dict, Any
 
-from fastmcp import FastMCP
+import orjson
+
+from fastmcp import Context, FastMCP
 from llm_guard.input_scanners import PromptInjection
 from llm_guard.output_scanners.sensitive import Sensitive
 
+try:
+    import hyperscan  # Optional: linear-time multi-regex matching
+except ImportError:
+    hyperscan = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 # --- Absolute Path Setup ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.json")
 LOG_FILE = os.path.join(SCRIPT_DIR, "security_events.json")
 GENERATED_REGEX_FILE = os.path.join(SCRIPT_DIR, "generated_regex.json")
+PARQUET_LOG_DIR = os.path.join(SCRIPT_DIR, "logs")
+
+# Once the JSONL spill file grows past this, its events are rotated into a
+# columnar Parquet partition that the dashboard can read without JSON parsing.
+LOG_ROTATE_BYTES = 1 << 20
 
 # --- Basic Setup ---
 logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 app = FastMCP()
 
 # --- Configuration and State ---
-IS_TAINTED: bool = False
+# Taint is tracked per MCP session, so one client's malicious prompt cannot
+# lock out every other connected client.
+_taint_lock = threading.Lock()
+_tainted_sessions: Dict[str, bool] = {}
+
+def _session_key(ctx: Context) -> str:
+    session_id = getattr(ctx, "session_id", None) if ctx is not None else None
+    return session_id or "default"
+
+def is_tainted(ctx: Context) -> bool:
+    with _taint_lock:
+        return _tainted_sessions.get(_session_key(ctx), False)
+
+def set_tainted(ctx: Context, value: bool):
+    with _taint_lock:
+        if value:
+            _tainted_sessions[_session_key(ctx)] = True
+        else:
+            _tainted_sessions.pop(_session_key(ctx), None)
 
 def load_config():
     """Loads the configuration from config.json using an absolute path."""
     try:
-        with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
+        with open(CONFIG_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
         # This is a critical error, but we provide safe defaults to avoid crashing.
         logging.error(f"FATAL: Could not load or parse config.json from {CONFIG_FILE}")
         return {
@@ -41,10 +82,30 @@ def load_config():
 def get_scanners(config: Dict[str, Any]):
     """Initializes scanners based on the provided configuration."""
     custom_patterns = config.get("custom_regex_patterns", [])
-    with open(GENERATED_REGEX_FILE, "w") as f:
-        json.dump(custom_patterns, f, indent=4)
-    
-    prompt_scanner = PromptInjection(threshold=config.get("prompt_injection_threshold", 0.99))
+    serialized_patterns = orjson.dumps(custom_patterns)
+    # Only rewrite the generated regex file when the patterns actually changed.
+    try:
+        with open(GENERATED_REGEX_FILE, "rb") as f:
+            on_disk = f.read()
+    except (FileNotFoundError, OSError):
+        on_disk = None
+    if on_disk != serialized_patterns:
+        with open(GENERATED_REGEX_FILE, "wb") as f:
+            f.write(serialized_patterns)
+
+    # ONNX Runtime inference is considerably faster than the FP32 PyTorch path
+    # on CPU; fall back transparently if onnxruntime/optimum are not installed.
+    use_onnx = config.get("use_onnx", True)
+    try:
+        prompt_scanner = PromptInjection(
+            threshold=config.get("prompt_injection_threshold", 0.99),
+            use_onnx=use_onnx
+        )
+    except Exception as e:
+        if not use_onnx:
+            raise
+        logging.warning(f"ONNX runtime unavailable, falling back to PyTorch inference: {e}")
+        prompt_scanner = PromptInjection(threshold=config.get("prompt_injection_threshold", 0.99))
     pii_scanner = Sensitive(
         entity_types=config.get("pii_entities_to_scan", []),
         redact=config.get("pii_scan_redact", True),
@@ -53,37 +114,260 @@ def get_scanners(config: Dict[str, Any]):
     )
     return prompt_scanner, pii_scanner
 
+def build_regex_prefilter(custom_patterns):
+    """Compiles all custom regex expressions into a single fast matcher.
+
+    Returns a callable reporting whether any custom pattern could match the
+    given text. Uses Hyperscan's linear-time multi-pattern DFA when the
+    binding is installed; otherwise falls back to one combined, pre-compiled
+    `re` alternation, which is still a single pass instead of one pass per
+    pattern.
+    """
+    expressions = [expr for pattern in custom_patterns for expr in pattern.get("expressions", [])]
+    if not expressions:
+        return lambda text: False
+
+    if hyperscan is not None:
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[expr.encode() for expr in expressions],
+            flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SOM_LEFTMOST] * len(expressions),
+        )
+
+        def matches(text: str) -> bool:
+            hits = []
+            db.scan(text.encode(), match_event_handler=lambda *args: hits.append(args))
+            return bool(hits)
+
+        return matches
+
+    combined = re.compile("|".join(f"(?:{expr})" for expr in expressions), re.IGNORECASE)
+    return lambda text: combined.search(text) is not None
+
+def make_cached_scans(prompt_scanner, pii_scanner):
+    """Wraps both scanners in bounded LRU caches keyed on the scanned text.
+
+    Retries and canned test inputs send identical strings repeatedly; caching
+    the scan results makes those calls free instead of re-running the
+    transformer model every time.
+    """
+    @functools.lru_cache(maxsize=1024)
+    def scan_prompt(text: str):
+        return prompt_scanner.scan(text)
+
+    @functools.lru_cache(maxsize=1024)
+    def scan_output(text: str):
+        return pii_scanner.scan(prompt="scan", output=text)
+
+    return scan_prompt, scan_output
+
+# Everything the hot paths need, specialized once per config load: the tool
+# handlers read plain attributes instead of repeating config.get lookups on
+# every request.
+ScannerState = collections.namedtuple(
+    "ScannerState",
+    ["config", "scan_prompt", "scan_output", "regex_prefilter",
+     "prompt_scan_enabled", "custom_regex_only"]
+)
+
+# Scanner construction loads HuggingFace transformer models, so the scanners are
+# cached here and only rebuilt when config.json's mtime changes.
+_scanner_lock = threading.Lock()
+_scanner_cache = None  # (config_mtime_ns, ScannerState)
+
+def get_cached_scanners() -> ScannerState:
+    """Returns the ScannerState, rebuilding only when config.json changes."""
+    global _scanner_cache
+    try:
+        config_mtime = os.stat(CONFIG_FILE).st_mtime_ns
+    except OSError:
+        config_mtime = -1
+    with _scanner_lock:
+        if _scanner_cache is None or _scanner_cache[0] != config_mtime:
+            config = load_config()
+            prompt_scanner, pii_scanner = get_scanners(config)
+            # Rebuilding also drops result caches tied to the old thresholds
+            scan_prompt, scan_output = make_cached_scans(prompt_scanner, pii_scanner)
+            state = ScannerState(
+                config=config,
+                scan_prompt=scan_prompt,
+                scan_output=scan_output,
+                regex_prefilter=build_regex_prefilter(config.get("custom_regex_patterns", [])),
+                prompt_scan_enabled=config.get("enable_prompt_injection_scanner", True),
+                custom_regex_only=config.get("pii_custom_regex_only", False),
+            )
+            _scanner_cache = (config_mtime, state)
+        return _scanner_cache[1]
+
+class MicroBatcher:
+    """Coalesces queued-up scan requests into batches handled off the event loop.
+
+    A solo request is processed immediately; requests that pile up while the
+    worker is busy are drained together on its next pass, so backlogged tool
+    calls take one orderly trip through the model instead of contending for
+    it, and the event loop stays free while inference runs in a thread.
+    """
+    def __init__(self, scan_batch, max_batch: int = 32):
+        self._scan_batch = scan_batch
+        self._max_batch = max_batch
+        self._queue = None
+        self._worker = None
+
+    async def scan(self, text: str):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            # Take only what is already waiting - never hold a request back
+            # hoping more will arrive.
+            batch = [await self._queue.get()]
+            while len(batch) < self._max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                results = await asyncio.to_thread(self._scan_batch, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+def _scan_prompt_batch(texts):
+    scan_prompt = get_cached_scanners().scan_prompt
+    return [scan_prompt(text) for text in texts]
+
+def _scan_output_batch(texts):
+    scan_output = get_cached_scanners().scan_output
+    return [scan_output(text) for text in texts]
+
+_prompt_batcher = MicroBatcher(_scan_prompt_batch)
+_output_batcher = MicroBatcher(_scan_output_batch)
+
 # --- Logging System ---
+def read_file_bytes(path) -> bytearray:
+    """Reads a whole file into one preallocated buffer via preadv.
+
+    A single sized submission instead of buffered open().read()'s chunked
+    reads and buffer regrowth. Falls back to a buffered read on platforms
+    without preadv.
+    """
+    if not hasattr(os, "preadv"):
+        with open(path, "rb") as f:
+            return bytearray(f.read())
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        buf = bytearray(os.fstat(fd).st_size)
+        view = memoryview(buf)
+        read = 0
+        while read < len(buf):
+            n = os.preadv(fd, [view[read:]], read)
+            if n == 0:
+                break
+            read += n
+        del view
+        del buf[read:]
+        return buf
+    finally:
+        os.close(fd)
+
+def migrate_legacy_log():
+    """One-time migration of a legacy JSON-array log file to JSONL (one event per line)."""
+    try:
+        if not os.path.exists(LOG_FILE) or os.path.getsize(LOG_FILE) == 0:
+            return
+        raw = read_file_bytes(LOG_FILE)
+        if not raw.startswith(b"["):
+            return  # Already JSONL
+        events = orjson.loads(raw)
+        with open(LOG_FILE, "wb") as f:
+            f.write(b"".join(orjson.dumps(e) + b"\n" for e in events))
+        logging.info(f"Migrated legacy JSON-array log to JSONL: {LOG_FILE}")
+    except Exception as e:
+        logging.error(f"Could not migrate legacy log file {LOG_FILE}: {e}")
+
+# Events are queued here and flushed to disk by a single background thread, so
+# the request path never blocks on file I/O.
+_log_queue = queue.SimpleQueue()
+
+def _rotate_log_to_parquet():
+    """Moves the events in the JSONL spill file into a timestamped Parquet partition.
+
+    Parquet partitions give the dashboard typed, compressed columns to read
+    instead of re-parsing old JSON; only recent unrotated events stay in the
+    JSONL file. The 'details' object is flattened into 'details.*' columns the
+    same way the dashboard flattens live events.
+    """
+    raw = read_file_bytes(LOG_FILE)
+    events = [orjson.loads(line) for line in raw.split(b"\n") if line.strip()]
+    if not events:
+        return
+    for event in events:
+        details = event.pop("details", None)
+        if isinstance(details, dict):
+            for key, value in details.items():
+                event[f"details.{key}"] = value
+        else:
+            event["details"] = details
+    os.makedirs(PARQUET_LOG_DIR, exist_ok=True)
+    partition = os.path.join(
+        PARQUET_LOG_DIR,
+        f"events-{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}.parquet"
+    )
+    pq.write_table(pa.Table.from_pylist(events), partition)
+    with open(LOG_FILE, "wb"):
+        pass  # Truncate: these events now live in the partition
+    logging.info(f"Rotated {len(events)} events into {partition}")
+
+def _log_writer():
+    """Drains the event queue, batching queued events into a single write."""
+    while True:
+        batch = [_log_queue.get()]
+        try:
+            while len(batch) < 256:
+                batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            with open(LOG_FILE, "ab") as f:
+                f.write(b"".join(orjson.dumps(event) + b"\n" for event in batch))
+            if pa is not None and os.path.getsize(LOG_FILE) >= LOG_ROTATE_BYTES:
+                _rotate_log_to_parquet()
+        except Exception as e:
+            logging.error(f"FATAL: Could not write to log file {LOG_FILE}: {e}")
+
 def log_event(event_type: str, details: Any, score: float, action: str):
-    """Appends a structured security event to the JSON log file."""
+    """Queues a structured security event for the background log writer."""
+    # orjson serializes datetime objects natively, no isoformat() needed
     event = {
-        "timestamp": datetime.datetime.utcnow().isoformat(), "event_type": event_type,
+        "timestamp": datetime.datetime.utcnow(), "event_type": event_type,
         "details": details, "risk_score": score, "action": action
     }
-    try:
-        data = []
-        if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
-            with open(LOG_FILE, "r") as f:
-                data = json.load(f)
-        data.append(event)
-        with open(LOG_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-    except Exception as e:
-        logging.error(f"FATAL: Could not write to log file {LOG_FILE}: {e}")
+    _log_queue.put(event)
+
+migrate_legacy_log()
+threading.Thread(target=_log_writer, name="aegis-log-writer", daemon=True).start()
 
 # --- Aegis Security Tools (Generic Middleware) ---
 @app.tool()
-def analyze_incoming_content(content_to_scan: str) -> Dict[str, Any]:
+async def analyze_incoming_content(content_to_scan: str, ctx: Context = None) -> Dict[str, Any]:
     """Scans inbound text for prompt injection."""
-    global IS_TAINTED
-    config = load_config() # Reload config on every call
-    prompt_injection_scanner, _ = get_scanners(config)
+    state = get_cached_scanners()
     risk_score = 0.0
 
-    if config.get("enable_prompt_injection_scanner", True):
-        _, is_valid, risk_score = prompt_injection_scanner.scan(content_to_scan)
+    if state.prompt_scan_enabled:
+        _, is_valid, risk_score = await _prompt_batcher.scan(content_to_scan)
         if not is_valid:
-            IS_TAINTED = True
+            set_tainted(ctx, True)
             details = {"reason": "High-risk prompt injection attempt detected.", "original_content": content_to_scan}
             log_event("INJECTION_DETECTED", details, risk_score, "BLOCKED_INPUT")
             return {"status": "SECURITY_ALERT", "action": "BLOCKED_INPUT", "is_valid": False, "risk_score": risk_score}
@@ -92,18 +376,25 @@ def analyze_incoming_content(content_to_scan: str) -> Dict[str, Any]:
     return {"status": "SUCCESS", "action": "ALLOWED_INPUT", "is_valid": True, "risk_score": risk_score}
 
 @app.tool()
-def scan_output_data(data_to_scan: str) -> Dict[str, Any]:
+async def scan_output_data(data_to_scan: str, ctx: Context = None) -> Dict[str, Any]:
     """Scans outbound text for sensitive PII."""
-    global IS_TAINTED
-    config = load_config() # Reload config on every call
-    _, pii_scanner = get_scanners(config)
+    state = get_cached_scanners()
 
-    if IS_TAINTED:
+    if is_tainted(ctx):
         details = {"reason": "Access denied because session is tainted."}
         log_event("ACCESS_DENIED", details, 1.0, "DENIED_ACCESS")
         return {"status": "ACCESS_DENIED", "action": "DENIED_ACCESS", "risk_score": 1.0}
 
-    sanitized_output, is_valid, risk_score = pii_scanner.scan(prompt="scan", output=data_to_scan)
+    # Fast path, opt-in only: when the operator declares the custom regex set
+    # to be the complete PII policy, a clean single-pass prefilter result means
+    # nothing can match. An empty pii_entities_to_scan does NOT imply this -
+    # llm-guard's Sensitive treats an empty entity list as "all default
+    # entity types", so inferring it would silently skip the broadest scan.
+    if state.custom_regex_only and not state.regex_prefilter(data_to_scan):
+        log_event("INFO", {"data": data_to_scan}, 0.0, "ALLOWED_OUTPUT")
+        return {"status": "SUCCESS", "action": "ALLOWED_OUTPUT", "risk_score": 0.0, "sanitized_data": data_to_scan}
+
+    sanitized_output, is_valid, risk_score = await _output_batcher.scan(data_to_scan)
     if not is_valid:
         details = {"original_data": data_to_scan, "redacted_data": sanitized_output, "reason": "Sensitive PII detected and redacted."}
         log_event("PII_REDACTED", details, risk_score, "REDACTED_OUTPUT")
@@ -113,10 +404,9 @@ def scan_output_data(data_to_scan: str) -> Dict[str, Any]:
     return {"status": "SUCCESS", "action": "ALLOWED_OUTPUT", "risk_score": 0.0, "sanitized_data": data_to_scan}
 
 @app.tool()
-def reset_security_session() -> Dict[str, str]:
-    """Resets the session's security state."""
-    global IS_TAINTED
-    IS_TAINTED = False
+def reset_security_session(ctx: Context = None) -> Dict[str, str]:
+    """Resets the calling session's security state."""
+    set_tainted(ctx, False)
     log_event("ADMIN_ACTION", {"action": "Session reset"}, 0.0, "SESSION_RESET")
     return {"status": "SUCCESS", "message": "Security session has been reset."}
 